@@ -11,7 +11,10 @@
 #================================================================================================
 """
 
+import math
+import time
 import pyvisa as visa
+from .sessionRecorder import RecordingInstrument, ReplayInstrument
 
 class Keith2230G():
     """
@@ -30,6 +33,21 @@ class Keith2230G():
     inst : visa instance
         instance of a generator.
     
+    voltage_limits : dict
+        maximum voltage in Volts allowed on each channel, read from the generator at connection.
+    
+    current_limits : dict
+        maximum current in Amps allowed on each channel, read from the generator at connection.
+    
+    power_limits : dict
+        maximum power in Watts (set voltage times set current) allowed on each channel. None for no check.
+    
+    slew_rates : dict
+        maximum voltage slew rate in Volts per second used when ramping each channel. None for no ramping.
+    
+    max_steps : dict
+        largest voltage step in Volts applied in one write when ramping each channel.
+    
     Methods
     ----------
     get_channel :
@@ -56,6 +74,18 @@ class Keith2230G():
     set_channel_output(channel, state) :
         Set the output state on the specified channel.
     
+    set_channel_limits(channel, volt, curr, power, slew_rate, max_step) :
+        Set the safe operating area and ramp parameters of the specified channel.
+    
+    get_channel_limits(channel) :
+        Returns the safe operating area and ramp parameters of the specified channel.
+    
+    ramp_channel_voltage(channel, volt, slew_rate) :
+        Ramps the voltage of the specified channel at a limited slew rate.
+    
+    ramp_channels_voltage(targets, slew_rate) :
+        Ramps the voltage of several channels concurrently at a limited slew rate.
+    
     reality_check :
         Print the set and measured current and voltage of every channel.
     
@@ -68,9 +98,9 @@ class Keith2230G():
     
     """
     
-    def __init__(self, adress, backend = '@ivi', reset = 0 ,silence_initial_measurements=0):
+    def __init__(self, adress, backend = '@ivi', reset = 0 ,silence_initial_measurements=0, record = None, replay = None):
         """
-        Initializes the instrument with instrument address, backend to use with pyvisa,reset and silencing initial measurements.
+        Initializes the instrument with instrument address, backend to use with pyvisa,reset, silencing initial measurements and session recording.
         
         Parameters
         ----------
@@ -85,13 +115,37 @@ class Keith2230G():
             
         silence_initial_measurements : bool, default = 0
             to silence initial measurements.
+        
+        record : str, default = None
+            path to a session file in which every exchange with the generator is recorded.
+        
+        replay : str, default = None
+            path to a recorded session file to replay instead of connecting to the generator.
         """
 
         self.adress = adress
-        self.ressource_manager = visa.ResourceManager(backend)
-        self.inst = self.ressource_manager.open_resource(self.adress)
+        self.voltage_limits = {}
+        self.current_limits = {}
+        self.power_limits = {'CH1':None,'CH2':None,'CH3':None}
+        self.slew_rates = {'CH1':None,'CH2':None,'CH3':None}
+        self.max_steps = {'CH1':0.1,'CH2':0.1,'CH3':0.1}
+        self._voltage_set = {}
+        self._current_set = {}
+        if replay:
+            self.ressource_manager = None
+            self.inst = ReplayInstrument(replay)
+        else:
+            self.ressource_manager = visa.ResourceManager(backend)
+            self.inst = self.ressource_manager.open_resource(self.adress)
+            if record:
+                self.inst = RecordingInstrument(self.inst, record)
         self.inst.write("SYST:REM \n") #put the keithley in remote mode
         
+        for i in ['CH1','CH2','CH3']: #read the maxima of this model
+            self.inst.write(f"INST:SEL {i}\n")
+            self.voltage_limits[i] = float(self.inst.query("SOUR:VOLT? MAX\n"))
+            self.current_limits[i] = float(self.inst.query("SOUR:CURR? MAX\n"))
+        
         if reset:
             self.inst.write("*RST \n")
             for i in ['CH1','CH2','CH3']:
@@ -213,8 +267,11 @@ class Keith2230G():
         """
            
         if channel in ['CH1','CH2','CH3']:
+            curr = float(curr)
+            self.__check_safe_operating_area(channel, self.__voltage_setpoint(channel), curr)
             self.inst.write(f"INST:SEL {channel}\n")
             self.inst.write(f"SOUR:CURR {curr} A\n")
+            self._current_set[channel] = curr
         else:
             raise ValueError("Value Error. Please enter a valid channel.")
             
@@ -232,11 +289,11 @@ class Keith2230G():
             the voltage in Volts.
         """
         if channel in ['CH1','CH2','CH3']:
+            volt = float(volt)
+            self.__check_safe_operating_area(channel, volt, self.__current_setpoint(channel))
             self.inst.write(f"INST:SEL {channel}\n")
-            if channel == 'CH3' and volt>6.1:
-                raise  ValueError("Value Error. Please enter a voltage below 6.1 for channel 3.")
-            else:
-                self.inst.write(f"SOUR:VOLT {volt} V\n")
+            self.inst.write(f"SOUR:VOLT {volt} V\n")
+            self._voltage_set[channel] = volt
         else:
             raise ValueError("Value Error. Please enter a valid channel.")
     
@@ -263,7 +320,213 @@ class Keith2230G():
                 raise ValueError("Value Error. Please enter a valid output state")
         else:
             raise ValueError("Value Error. Please enter a valid channel.")
-    
+
+    def set_channel_limits(self, channel, volt = None, curr = None, power = None, slew_rate = None, max_step = None):
+        """
+        Sets the safe operating area and ramp parameters of the specified channel.
+
+        Parameters
+        ----------
+        channel : str
+            The selected channel. can be CH1, CH2 or CH3.
+
+        volt : float, default = None
+            maximum voltage in Volts. By default no changes are applied.
+
+        curr : float, default = None
+            maximum current in Amps. By default no changes are applied.
+
+        power : float, default = None
+            maximum power in Watts. By default no changes are applied, the power being unchecked unless set.
+
+        slew_rate : float, default = None
+            maximum voltage slew rate in Volts per second used by the ramps. By default no changes are applied.
+
+        max_step : float, default = None
+            largest voltage step in Volts applied in one write by the ramps. By default no changes are applied.
+        """
+        if channel not in ['CH1','CH2','CH3']:
+            raise ValueError("Value Error. Please enter a valid channel.")
+        for value in [volt, curr, power, slew_rate, max_step]:
+            if value != None and value <= 0:
+                raise ValueError("Value Error. Please enter positive limits.")
+        if volt != None:
+            self.voltage_limits[channel] = volt
+        if curr != None:
+            self.current_limits[channel] = curr
+        if power != None:
+            self.power_limits[channel] = power
+        if slew_rate != None:
+            self.slew_rates[channel] = slew_rate
+        if max_step != None:
+            self.max_steps[channel] = max_step
+
+    def get_channel_limits(self, channel):
+        """
+        Returns the safe operating area and ramp parameters of the specified channel.
+
+        Parameters
+        ----------
+        channel : str
+            The selected channel. can be CH1, CH2 or CH3.
+
+        Returns
+        ----------
+        dict
+        """
+        if channel not in ['CH1','CH2','CH3']:
+            raise ValueError("Value Error. Please enter a valid channel.")
+        return({'volt':self.voltage_limits[channel], 'curr':self.current_limits[channel],
+                'power':self.power_limits[channel], 'slew_rate':self.slew_rates[channel],
+                'max_step':self.max_steps[channel]})
+
+    def ramp_channel_voltage(self, channel, volt, slew_rate = None):
+        """
+        Ramps the voltage of the specified channel to the given value without exceeding the slew rate.
+
+        Parameters
+        ----------
+        channel : str
+            The selected channel. can be CH1, CH2 or CH3.
+
+        volt : float
+            the final voltage in Volts.
+
+        slew_rate : float, default = None
+            slew rate in Volts per second. By default the channel's slew rate is used.
+
+        Returns
+        ----------
+        list of (time, channel, voltage) tuples, the set-points written with their time in seconds from the start of the ramp.
+        """
+        return(self.ramp_channels_voltage({channel:volt}, slew_rate))
+
+    def ramp_channels_voltage(self, targets, slew_rate = None):
+        """
+        Ramps the voltage of several channels concurrently without exceeding their slew rates.
+
+        Every target is checked against the safe operating area and the voltage set on every ramped
+        channel is queried before anything is written. Each ramp is cut in the minimal number of steps
+        no larger than the channel's max_step, step k being written at (k+1) times the time the slew rate
+        needs for one step, and the set-points of all the channels are interleaved on a single monotonic
+        schedule. When a write is late, the rest of that channel's ramp is delayed by as much.
+
+        Parameters
+        ----------
+        targets : dict
+            final voltage in Volts for each channel, e.g. {'CH1':5., 'CH2':12.}.
+
+        slew_rate : float, default = None
+            slew rate in Volts per second used for every channel. By default each channel's slew rate is used.
+
+        Returns
+        ----------
+        list of (time, channel, voltage) tuples, the set-points written with their time in seconds from the start of the ramp.
+        """
+        if slew_rate != None and slew_rate <= 0:
+            raise ValueError("Value Error. Please enter a positive slew rate.")
+        targets = {channel:float(volt) for channel, volt in targets.items()}
+        for channel, volt in targets.items():
+            if channel not in ['CH1','CH2','CH3']:
+                raise ValueError("Value Error. Please enter a valid channel.")
+            self.__check_safe_operating_area(channel, volt, self.__current_setpoint(channel))
+        schedules = {}
+        for channel, volt in targets.items():
+            self._voltage_set[channel] = float(self.get_channel_voltage_set(channel))
+            rate = slew_rate if slew_rate != None else self.slew_rates[channel]
+            schedules[channel] = self.__ramp_schedule(channel, self._voltage_set[channel], volt, rate)
+        shifts = {channel:0. for channel in schedules}
+
+        written = []
+        selected = None
+        start = time.monotonic()
+        while any(schedules.values()):
+            channel = min([c for c in schedules if schedules[c]], key = lambda c: schedules[c][0][0] + shifts[c])
+            delay, volt = schedules[channel].pop(0)
+            planned = delay + shifts[channel]
+            remaining = start + planned - time.monotonic()
+            if remaining > 0:
+                time.sleep(remaining)
+            elapsed = time.monotonic() - start
+            # a late step delays the rest of the ramp instead of bursting to catch up.
+            shifts[channel] += max(0., elapsed - planned)
+            if channel != selected:
+                self.inst.write(f"INST:SEL {channel}\n")
+                selected = channel
+            self.inst.write(f"SOUR:VOLT {volt} V\n")
+            self._voltage_set[channel] = volt
+            written.append((elapsed, channel, volt))
+        return(written)
+
+    def __ramp_schedule(self, channel, start, stop, slew_rate):
+        """
+        private method, computes the set-points of a ramp.
+
+        Parameters
+        ----------
+        channel : str
+            The selected channel.
+
+        start : float
+            the initial voltage in Volts.
+
+        stop : float
+            the final voltage in Volts.
+
+        slew_rate : float
+            slew rate in Volts per second, None to step directly to the final voltage.
+
+        Returns
+        ----------
+        list of (time, voltage) tuples.
+        """
+        if stop == start:
+            return([])
+        if slew_rate == None:
+            return([(0., stop)])
+        nb_steps = math.ceil(round(abs(stop - start)/self.max_steps[channel], 9))
+        step = (stop - start)/nb_steps
+        dwell = abs(step)/slew_rate
+        return([((k+1)*dwell, round(start + (k+1)*step, 6)) for k in range(nb_steps - 1)] + [(nb_steps*dwell, stop)])
+
+    def __check_safe_operating_area(self, channel, volt, curr):
+        """
+        private method, raises a ValueError if a set-point is outside the channel's safe operating area.
+
+        Parameters
+        ----------
+        channel : str
+            The selected channel.
+
+        volt : float
+            the voltage set-point in Volts.
+
+        curr : float
+            the current set-point in Amps.
+        """
+        if volt < 0 or volt > self.voltage_limits[channel]:
+            raise ValueError(f"Value Error. Please enter a voltage between 0 and {self.voltage_limits[channel]} for channel {channel[2]}.")
+        if curr < 0 or curr > self.current_limits[channel]:
+            raise ValueError(f"Value Error. Please enter a current between 0 and {self.current_limits[channel]} for channel {channel[2]}.")
+        if self.power_limits[channel] != None and volt*curr > self.power_limits[channel]:
+            raise ValueError(f"Value Error. Please keep the power below {self.power_limits[channel]} W for channel {channel[2]}.")
+
+    def __voltage_setpoint(self, channel):
+        """
+        private method, returns the last voltage set on the channel, queried once from the generator if unknown.
+        """
+        if channel not in self._voltage_set:
+            self._voltage_set[channel] = float(self.get_channel_voltage_set(channel))
+        return(self._voltage_set[channel])
+
+    def __current_setpoint(self, channel):
+        """
+        private method, returns the last current set on the channel, queried once from the generator if unknown.
+        """
+        if channel not in self._current_set:
+            self._current_set[channel] = float(self.get_channel_current_set(channel))
+        return(self._current_set[channel])
+
     def reality_check(self):
         """
         Prints the set and measured current and voltage of every channel.
@@ -13,13 +13,56 @@
 import sys
 import pyvisa as visa
 import numpy as np
-from comtypes.client import GetModule
-from comtypes.client import CreateObject
-from comtypes.automation import VARIANT
-# Run GetModule once to generate comtypes.gen.VisaComLib.
-if not hasattr(sys, "frozen"):
-   GetModule("C:\Program Files (x86)\IVI Foundation\VISA\VisaCom\GlobMgr.dll")
-import comtypes.gen.VisaComLib as VisaComLib
+from .sessionRecorder import RecordingInstrument, ReplayInstrument
+
+# VISA COM library, imported when connecting to a scope so that sessions can be replayed without it.
+VisaComLib = None
+
+
+def import_visa_com():
+    """
+    Imports the VISA COM library, running GetModule once to generate comtypes.gen.VisaComLib.
+    
+    Returns
+    ----------
+    module
+    """
+    global VisaComLib
+    if VisaComLib == None:
+        from comtypes.client import GetModule
+        if not hasattr(sys, "frozen"):
+            GetModule(r"C:\Program Files (x86)\IVI Foundation\VISA\VisaCom\GlobMgr.dll")
+        import comtypes.gen.VisaComLib
+        VisaComLib = comtypes.gen.VisaComLib
+    return VisaComLib
+
+
+def split_answers(answers):
+    """
+    Splits the answer to a compound query on the ";" separating each query's answer, ignoring those within quoted strings.
+    
+    Parameters
+    ----------
+    answers : str
+        The answer read from the scope.
+    
+    Returns
+    ----------
+    string list
+    """
+    result = []
+    current = ""
+    quoted = False
+    for character in answers.strip():
+        if character == '"':
+            quoted = not quoted
+        if character == ';' and not quoted:
+            result.append(current)
+            current = ""
+        else:
+            current += character
+    result.append(current)
+    return result
 
 
 class Keys204A():
@@ -39,10 +82,19 @@ class Keys204A():
     inst : comtypes.POINTER(IFormattedIO488)
         comtypes instance.
     
+    timeout : int
+        base I/O timeout in milliseconds.
+    
+    timeout_per_point : float
+        timeout added per requested waveform point in milliseconds.
+    
     Methods
     ----------
     do_command(command) : 
         sends a command to the scope.
+    
+    do_commands(commands) :
+        sends several commands to the scope in a single message.
         
     do_query_string(query) :
         queries the scope and return the answer as a string.
@@ -52,6 +104,15 @@ class Keys204A():
         
     do_query_number(query) :
         queries the scope for a number.
+    
+    do_query_strings(queries) :
+        queries the scope with several pipelined queries and return the answers as strings.
+    
+    do_query_numbers(queries) :
+        queries the scope with several pipelined queries for numbers.
+    
+    set_io(timeout, chunk_size, timeout_per_point) :
+        set the I/O timeout and read buffer size.
         
     set_trigger(trigger_channel,trigger_sweep,trigger_level) :
         set the trigger parameters.
@@ -68,13 +129,16 @@ class Keys204A():
     save_waveform(channel, name, path) : 
         retrieve and save a displayed waveform on the specified channel.
     
+    close :
+        close the link with the scope and the recorded session.
+    
     
     
     """
     
-    def __init__(self, adress, backend = '@ivi'):
+    def __init__(self, adress, backend = '@ivi', record = None, replay = None, timeout = None, chunk_size = None, timeout_per_point = 1e-3):
         """
-        Initializes the instrument with instrument address, backend to use with pyvisa.
+        Initializes the instrument with instrument address, backend to use with pyvisa, session recording and I/O parameters.
         
         Parameters
         ----------
@@ -83,18 +147,49 @@ class Keys204A():
         
         backend : str, default : '@ivi'
             Backend to use for pyvisa.
-        """
         
-        self.adress = adress
+        record : str, default = None
+            path to a session file in which every exchange with the scope is recorded.
         
-        self.ressource_manager = CreateObject("VISA.GlobalRM", \
-        interface=VisaComLib.IResourceManager)
-        self.inst = CreateObject("VISA.BasicFormattedIO", \
-        interface=VisaComLib.IFormattedIO488)
-        self.inst.IO = self.ressource_manager.Open(adress)
-        # Clear the interface.
-        self.inst.IO.Clear
+        replay : str, default = None
+            path to a recorded session file to replay instead of connecting to the scope.
         
+        timeout : int, default = None
+            base I/O timeout in milliseconds. By default the VISA timeout is kept.
+        
+        chunk_size : int, default = None
+            size in bytes of the read buffer used for large transfers. By default the VISA buffer is kept.
+        
+        timeout_per_point : float, default = 1e-3
+            timeout added per requested waveform point in milliseconds, for slow links.
+        """
+        
+        self.adress = adress
+        self._replay = bool(replay)
+        self.timeout = 2000
+        self.timeout_per_point = timeout_per_point
+        
+        if replay:
+            self.ressource_manager = None
+            self.inst = ReplayInstrument(replay)
+            # the read format is not checked on replay.
+            self._binary_type_I2 = None
+        else:
+            import_visa_com()
+            from comtypes.client import CreateObject
+            self._binary_type_I2 = VisaComLib.BinaryType_I2
+            self.ressource_manager = CreateObject("VISA.GlobalRM", \
+            interface=VisaComLib.IResourceManager)
+            self.inst = CreateObject("VISA.BasicFormattedIO", \
+            interface=VisaComLib.IFormattedIO488)
+            self.inst.IO = self.ressource_manager.Open(adress)
+            # Clear the interface.
+            self.inst.IO.Clear
+            self.timeout = self.inst.IO.Timeout
+            if record:
+                self.inst = RecordingInstrument(self.inst, record)
+        
+        self.set_io(timeout, chunk_size)
         
         print("Connected Device : " + self.do_query_string("*IDN?"))
     
@@ -107,12 +202,25 @@ class Keys204A():
         command : str
             The command to send to the scope.
         """
-        self.inst.WriteString("%s" % command, True)
-        self.__check_instrument_errors(command)
+        self.do_commands([command])
+    
+    def do_commands(self,commands):
+        """
+        enables prompting several commands to the scope in a single message, the error query being
+        sent in the same message so that the whole batch costs a single round-trip.
+        
+        Parameters
+        ----------
+        commands : str list
+            The commands to send to the scope, with their full path (e.g. ":TIMebase:SCALe 1e-3").
+        """
+        command = ";".join(commands)
+        self.inst.WriteString("%s;:SYSTem:ERRor? STRing" % command, True)
+        self.__check_error_string(self.inst.ReadString(), command)
         
     def do_query_string(self,query):
         """
-        enables querying easily the scope.
+        enables querying easily the scope, the error query being sent in the same message.
         
         Parameters
         ----------
@@ -123,14 +231,15 @@ class Keys204A():
         ----------
         string
         """
-        self.inst.WriteString("%s" % query, True)
-        result = self.inst.ReadString()
-        self.__check_instrument_errors(query)
-        return result
+        self.inst.WriteString("%s;:SYSTem:ERRor? STRing" % query, True)
+        result = split_answers(self.inst.ReadString())
+        self.__check_error_string(result.pop(), query)
+        return ";".join(result)
     
     def do_query_ieee_block_I2(self,query):
         """
-        enables querying easily the scope for binary data.
+        enables querying easily the scope for binary data, the error query being sent in the same message
+        and its answer read after the block.
         
         Parameters
         ----------
@@ -141,15 +250,16 @@ class Keys204A():
         ----------
         list
         """
-        self.inst.WriteString("%s" % query, True)
-        result = self.inst.ReadIEEEBlock(VisaComLib.BinaryType_I2, \
-        False, True)
-        self.__check_instrument_errors(query)
+        self.inst.WriteString("%s;:SYSTem:ERRor? STRing" % query, True)
+        # the block is read without flushing to the end of the message, the error string follows it.
+        result = self.inst.ReadIEEEBlock(self._binary_type_I2, \
+        False, False)
+        self.__check_error_string(self.inst.ReadString().strip().lstrip(";"), query)
         return result
     
     def do_query_number(self,query):
         """
-        enables querying easily the scope for a number.
+        enables querying easily the scope for a number, the error query being sent in the same message.
         
         Parameters
         ----------
@@ -160,35 +270,103 @@ class Keys204A():
         ----------
         float
         """
-        self.inst.WriteString("%s" % query, True)
-        result = self.inst.ReadNumber(VisaComLib.ASCIIType_R8, True)
-        self.__check_instrument_errors(query)
+        return float(self.do_query_string(query))
+    
+    def do_query_strings(self,queries):
+        """
+        enables querying the scope with several pipelined queries: they are sent in a single message,
+        with the error query, and the answers are read back in order, paying one round-trip for all of them.
+        The headers are turned off (":SYSTem:HEADer OFF") so that the answers hold the values only.
+        
+        Parameters
+        ----------
+        queries : str list
+            The queries to send to the scope, with their full path (e.g. ":WAVeform:XINCrement?").
+        
+        Returns
+        ----------
+        string list
+        """
+        query = ";".join(queries)
+        self.inst.WriteString(":SYSTem:HEADer OFF;%s;:SYSTem:ERRor? STRing" % query, True)
+        result = split_answers(self.inst.ReadString())
+        self.__check_error_string(result.pop() if result else "", query)
+        if len(result) != len(queries):
+            raise ValueError("Value Error. %d answers received for %d queries: '%s'." % (len(result), len(queries), query))
         return result
     
-    def __check_instrument_errors(self,command):
+    def do_query_numbers(self,queries):
+        """
+        enables querying the scope with several pipelined queries for numbers.
+        
+        Parameters
+        ----------
+        queries : str list
+            The queries to send to the scope, with their full path.
+        
+        Returns
+        ----------
+        float list
+        """
+        return [float(result) for result in self.do_query_strings(queries)]
+    
+    def set_io(self, timeout = None, chunk_size = None, timeout_per_point = None):
+        """
+        set the I/O timeout and the size of the read buffer, which sets the chunk size of large reads such as ":WAVeform:DATA?".
+        
+        Parameters
+        ----------
+        timeout : int, default = None
+            base I/O timeout in milliseconds. By default no changes are applied.
+        
+        chunk_size : int, default = None
+            size in bytes of the read buffer. By default no changes are applied.
+        
+        timeout_per_point : float, default = None
+            timeout added per requested waveform point in milliseconds. By default no changes are applied.
+        """
+        if timeout != None:
+            self.timeout = timeout
+            self.__set_timeout(timeout)
+        if timeout_per_point != None:
+            self.timeout_per_point = timeout_per_point
+        if chunk_size != None and not self._replay:
+            self.inst.SetBufferSize(VisaComLib.IO_IN_BUF, chunk_size)
+    
+    def __set_timeout(self,timeout):
         """
-        private method, enables detection of errors.
+        private method, sets the VISA I/O timeout.
         
         Parameters
         ----------
+        timeout : int
+            The timeout in milliseconds.
+        """
+        if not self._replay:
+            self.inst.IO.Timeout = int(timeout)
+    
+    def __check_error_string(self,error_string,command):
+        """
+        private method, exits if the answer to ":SYSTem:ERRor? STRing" is an error.
+        
+        Parameters
+        ----------
+        error_string : str
+            The answer to the error query.
+        
         command : str
             The command passed to the scope.
         """
-        while True:
-            self.inst.WriteString(":SYSTem:ERRor? STRing", True)
-            error_string = self.inst.ReadString()
-            if error_string: # If there is an error string value.
-                if error_string.find("0,", 0, 2) == -1: # Not "No error".
-                    print("ERROR: %s, command: '%s'" % (error_string, command))
-                    print("Exited because of error.")
-                    sys.exit(1)
-                else: # "No error"
-                    break
-
-            else: # :SYSTem:ERRor? STRing should always return string.
-                print("ERROR: :SYSTem:ERRor? STRing returned nothing, command: '%s'"% command)
+        if error_string: # If there is an error string value.
+            if error_string.find("0,", 0, 2) == -1: # Not "No error".
+                print("ERROR: %s, command: '%s'" % (error_string, command))
                 print("Exited because of error.")
                 sys.exit(1)
+
+        else: # :SYSTem:ERRor? STRing should always return string.
+            print("ERROR: :SYSTem:ERRor? STRing returned nothing, command: '%s'"% command)
+            print("Exited because of error.")
+            sys.exit(1)
         
     
     def set_trigger(self,trigger_channel = 1,trigger_sweep = None ,trigger_level = None, print_output = 0):
@@ -210,22 +388,24 @@ class Keys204A():
             wether to prit or not the new setting to verify all is good.
         """
         
+        commands = []
         if trigger_sweep != None:
-            self.do_command(":TRIGger:SWEep "+trigger_sweep)
+            commands.append(":TRIGger:SWEep "+trigger_sweep)
 
-        self.do_command(":TRIGger:EDGE:SOURce CHANnel" + str(trigger_channel))
+        commands.append(":TRIGger:EDGE:SOURce CHANnel" + str(trigger_channel))
         
         if trigger_level !=None:
-            self.do_command(":TRIGger:LEVel CHANnel" + str(trigger_channel)+","+str(trigger_level))
+            commands.append(":TRIGger:LEVel CHANnel" + str(trigger_channel)+","+str(trigger_level))
+        self.do_commands(commands)
 
         
         if print_output == 1:
-            qresult = self.do_query_string(":TRIGger:SWEep?")
-            print("Trigger sweep: %s" % qresult)
-            qresult = self.do_query_string(":TRIGger:EDGE:SOURce?")
-            print("Trigger edge source: %s" % qresult)
-            qresult = self.do_query_string(":TRIGger:LEVel? CHANnel"+ str(trigger_channel))
-            print("Trigger level, channel" + str(trigger_channel)+": %s" % qresult)
+            qresults = self.do_query_strings([":TRIGger:SWEep?",
+                                              ":TRIGger:EDGE:SOURce?",
+                                              ":TRIGger:LEVel? CHANnel"+ str(trigger_channel)])
+            print("Trigger sweep: %s" % qresults[0])
+            print("Trigger edge source: %s" % qresults[1])
+            print("Trigger level, channel" + str(trigger_channel)+": %s" % qresults[2])
     
     def time_base(self,time_scale, time_ref,print_output = 0):
         """
@@ -243,17 +423,17 @@ class Keys204A():
             wether to prit or not the new setting to verify all is good.
         """
         # Set horizontal scale and offset.
-        self.do_command(":TIMebase:SCALe " + str(time_scale))
-        self.do_command(":TIMebase:POSition 0.0")
-        self.do_command(":TIMebase:REFerence:PERCent " + str(time_ref))
+        self.do_commands([":TIMebase:SCALe " + str(time_scale),
+                          ":TIMebase:POSition 0.0",
+                          ":TIMebase:REFerence:PERCent " + str(time_ref)])
         
         if print_output == 1:
-            qresult = self.do_query_string(":TIMebase:SCALe?")
-            print("Timebase scale: %s" % qresult)
-            qresult = self.do_query_string(":TIMebase:POSition?")
-            print("Timebase position: %s" % qresult)
-            qresult = self.do_query_string(":TIMebase:REFerence:PERCent?")
-            print(" Timebase reference percent: %s" %qresult)
+            qresults = self.do_query_strings([":TIMebase:SCALe?",
+                                              ":TIMebase:POSition?",
+                                              ":TIMebase:REFerence:PERCent?"])
+            print("Timebase scale: %s" % qresults[0])
+            print("Timebase position: %s" % qresults[1])
+            print(" Timebase reference percent: %s" %qresults[2])
     
         
     def set_channels(self, channels=[1,2,3,4], displays = [1,1,1,1], y_scales = [1,1,1,1], offsets = [0.,0.,0.,0.], probes = [None,None,None,None] , input_couplings = ['DC','DC','DC','DC'],print_output = 0):
@@ -291,32 +471,41 @@ class Keys204A():
         print_output : boolean, default = 0
             wether to prit or not the new setting to verify all is good.
         """
+        commands = []
         for i in range(len(channels)):
             c = channels[i]
             if probes[i] != None : 
-                self.do_command(":CHANnel"+ str(c)+":PROBe "+str(probes[i]))
+                commands.append(":CHANnel"+ str(c)+":PROBe "+str(probes[i]))
             if displays[i] != None :
-                self.do_command(":CHANnel"+ str(c)+":DISPlay "+str(displays[i]))
+                commands.append(":CHANnel"+ str(c)+":DISPlay "+str(displays[i]))
             if y_scales[i] != None :
-                self.do_command(":CHANnel" +str(c)+ ":SCALe " + str(y_scales[i]))
+                commands.append(":CHANnel" +str(c)+ ":SCALe " + str(y_scales[i]))
             
             if offsets[i] != None :
-                self.do_command(":CHANnel" +str(c)+ ":OFFSet "+str(offsets[i]))
+                commands.append(":CHANnel" +str(c)+ ":OFFSet "+str(offsets[i]))
             
             if input_couplings[i] != None :
-                self.do_command(":CHANnel"+ str(c)+":INPut "+ input_couplings[i])
+                commands.append(":CHANnel"+ str(c)+":INPut "+ input_couplings[i])
+        # every channel is set in a single message.
+        if commands:
+            self.do_commands(commands)
             
-            if print_output == 1:
-                qresult = self.do_query_string(":CHANnel"+ str(c)+":PROBe?")
-                print("Channel "+ str(c)+" probe attenuation factor: %s" % qresult)
-                qresult = self.do_query_string(":CHANnel"+ str(c)+":DISPlay?")
-                print("Channel "+ str(c)+" display: %s" % qresult)
-                qresult = self.do_query_string(":CHANnel" +str(c)+ ":SCALe?")
-                print("Channel " +str(c)+ " vertical scale: "+qresult)
-                qresult = self.do_query_string(":CHANnel" +str(c)+ ":OFFSet?")
-                print("Channel " +str(c)+ " offset: "+ qresult)
-                qresult = self.do_query_string(":CHANnel"+str(c)+":INPut?")
-                print("load imp channel" +str(c)+" : %s" %qresult)
+        if print_output == 1:
+            queries = []
+            for c in channels:
+                queries += [":CHANnel"+ str(c)+":PROBe?",
+                            ":CHANnel"+ str(c)+":DISPlay?",
+                            ":CHANnel" +str(c)+ ":SCALe?",
+                            ":CHANnel" +str(c)+ ":OFFSet?",
+                            ":CHANnel"+str(c)+":INPut?"]
+            qresults = self.do_query_strings(queries)
+            for i in range(len(channels)):
+                c = channels[i]
+                print("Channel "+ str(c)+" probe attenuation factor: %s" % qresults[5*i])
+                print("Channel "+ str(c)+" display: %s" % qresults[5*i+1])
+                print("Channel " +str(c)+ " vertical scale: "+qresults[5*i+2])
+                print("Channel " +str(c)+ " offset: "+ qresults[5*i+3])
+                print("load imp channel" +str(c)+" : %s" %qresults[5*i+4])
 
     def retrieve_waveform(self,channel,nb_points):
         """
@@ -332,20 +521,25 @@ class Keys204A():
         ----------
         x, y : numpy arrays
         """
-        self.do_command(":ACQuire:POINts "+str(nb_points))
-        self.do_command(":RUN")
-        self.do_command(":WAVeform:SOURce channel"+str(channel))
-        self.do_command(":WAVeform:FORMat word")
-        self.do_command(":SYSTem:HEADer OFF")
-        self.do_command(":WAVeform:STReaming OFF")
-        number_of_points=self.do_query_string(":WAVeform:POINts?")
-        y_increment = self.do_query_number(":WAVeform:YINCrement?")
-        y_origin = self.do_query_number(":WAVeform:YORigin?")
-        x_increment = self.do_query_number(":WAVeform:XINCrement?")
-        x_origin = self.do_query_number(":WAVeform:XORigin?")
-        waveform_raw = self.do_query_ieee_block_I2(":WAVeform:DATA?")
+        # the timeout scales with the number of points to transfer.
+        self.__set_timeout(self.timeout + nb_points*self.timeout_per_point)
+        try:
+            self.do_commands([":ACQuire:POINts "+str(nb_points),
+                              ":RUN",
+                              ":WAVeform:SOURce channel"+str(channel),
+                              ":WAVeform:FORMat word",
+                              ":SYSTem:HEADer OFF",
+                              ":WAVeform:STReaming OFF"])
+            number_of_points, y_increment, y_origin, x_increment, x_origin = self.do_query_numbers([":WAVeform:POINts?",
+                                                                                                    ":WAVeform:YINCrement?",
+                                                                                                    ":WAVeform:YORigin?",
+                                                                                                    ":WAVeform:XINCrement?",
+                                                                                                    ":WAVeform:XORigin?"])
+            waveform_raw = self.do_query_ieee_block_I2(":WAVeform:DATA?")
 
-        self.do_command(":RUN")
+            self.do_command(":RUN")
+        finally:
+            self.__set_timeout(self.timeout)
 
         y_waveform = y_increment*np.array(waveform_raw) +y_origin
         x_waveform = x_increment*np.array(range(int(number_of_points)))+x_origin
@@ -375,6 +569,15 @@ class Keys204A():
         x,y = self.retrieve_waveform(channel,nb_points)
         data_to_store = np.stack((x,y), axis=1)
         np.save(path + name+'.npy',data_to_store)
+    
+    def close(self):
+        """
+        Closes the link with the scope and, when recording or replaying, the session.
+        """
+        if not self._replay:
+            self.inst.IO.Close()
+        if isinstance(self.inst, (RecordingInstrument, ReplayInstrument)):
+            self.inst.close()
          
 #   def template(self, parameters):
 #        """
@@ -0,0 +1,205 @@
+"""
+================================================================================================
+# this is a library enabling the recording and the replay of a remote control session.
+#
+# develloped @ C2N, palaiseau.
+#
+# Every SCPI exchange with an instrument is appended to a session file, which can then be
+# replayed with no instrument attached, e.g. to re-run an analysis offline.
+#
+# The session file holds one JSON line per exchange. Binary blocks are stored in a side-car
+# numpy archive (session file name + '.npz'), the JSON line holding the block's key in it.
+# Neither file can execute code when loaded.
+#
+#================================================================================================
+"""
+
+import os
+import json
+import numpy as np
+
+
+# methods sending a command without reading anything back.
+WRITE_METHODS = ['write', 'WriteString']
+
+# methods sending a command and reading the answer back in one call.
+QUERY_METHODS = ['query']
+
+# methods reading an answer back.
+READ_METHODS = ['read', 'ReadString', 'ReadNumber', 'ReadIEEEBlock']
+
+
+def compact_response(response):
+    """
+    Stores binary blocks (tuples or lists of integers) as numpy arrays of the smallest integer type.
+
+    Parameters
+    ----------
+    response : any
+        The answer read from the instrument.
+
+    Returns
+    ----------
+    the answer, binary blocks being numpy arrays.
+    """
+    if isinstance(response, (tuple, list)) and len(response) > 0 and all(isinstance(i, int) for i in response):
+        array = np.asarray(response)
+        for dtype in [np.int8, np.int16, np.int32]:
+            if array.min() >= np.iinfo(dtype).min and array.max() <= np.iinfo(dtype).max:
+                return array.astype(dtype)
+        return array
+    return response
+
+
+class RecordingInstrument():
+    """
+    class that wraps an instrument instance and records every exchange in a session file.
+
+    ...
+
+    Attributes
+    ----------
+    inst : visa or comtypes instance
+        the wrapped instrument.
+
+    path : str
+        path to the session file.
+
+    Methods
+    ----------
+    close :
+        Closes the wrapped instrument and the session file, and saves the binary blocks.
+    """
+
+    def __init__(self, inst, path):
+        """
+        Wraps the instrument and opens the session file, overwriting it if it exists.
+        The binary blocks are saved in path + '.npz' when closing.
+
+        Parameters
+        ----------
+        inst : visa or comtypes instance
+            The instrument to record.
+
+        path : str
+            path to the session file.
+        """
+        self.inst = inst
+        self.path = path
+        self._file = open(path, 'w')
+        self._blocks = {}
+
+    def __getattr__(self, name):
+        attribute = getattr(self.inst, name)
+        if name not in WRITE_METHODS + QUERY_METHODS + READ_METHODS:
+            return attribute
+
+        def recorded_call(*args):
+            response = attribute(*args)
+            self.__dump(name, args, response)
+            return response
+        return recorded_call
+
+    def __dump(self, method, args, response):
+        """
+        private method, appends an exchange to the session file.
+
+        Parameters
+        ----------
+        method : str
+            The name of the method called on the instrument.
+
+        args : tuple
+            The arguments of the call.
+
+        response : any
+            The answer read from the instrument, None for a write.
+        """
+        exchange = {'method':method, 'args':list(args)}
+        response = compact_response(response)
+        if isinstance(response, np.ndarray):
+            exchange['block'] = 'block_%d' % len(self._blocks)
+            self._blocks[exchange['block']] = response
+        else:
+            exchange['response'] = response
+        self._file.write(json.dumps(exchange) + '\n')
+        self._file.flush()
+
+    def close(self):
+        """
+        Closes the wrapped instrument, if it has a close method, and the session file, and saves the binary blocks.
+        """
+        if hasattr(self.inst, 'close'):
+            self.inst.close()
+        self._file.close()
+        np.savez(self.path + '.npz', **self._blocks)
+
+
+class ReplayInstrument():
+    """
+    class that replaces an instrument instance by the exchanges recorded in a session file.
+
+    The whole file is loaded in memory and the exchanges are replayed in the recorded order.
+    A ValueError is raised on the first call differing from the recording (method, or command for writes and queries)
+    and on any call once the recording is exhausted, so that a replay never serves answers to other commands.
+    Binary blocks are returned as numpy arrays.
+
+    ...
+
+    Attributes
+    ----------
+    path : str
+        path to the session file.
+
+    Methods
+    ----------
+    close :
+        Does nothing, there is no instrument to close.
+    """
+
+    def __init__(self, path):
+        """
+        Loads the session file and its binary blocks.
+
+        Parameters
+        ----------
+        path : str
+            path to the session file.
+        """
+        self.path = path
+        self._exchanges = []
+        self._position = 0
+        blocks = {}
+        if os.path.exists(path + '.npz'):
+            with np.load(path + '.npz', allow_pickle = False) as archive:
+                blocks = {key:archive[key] for key in archive.files}
+        with open(path, 'r') as file:
+            for line in file:
+                exchange = json.loads(line)
+                if 'block' in exchange:
+                    if exchange['block'] not in blocks:
+                        raise ValueError("Value Error. %s is missing from %s.npz, was the recording closed?" % (exchange['block'], path))
+                    response = blocks[exchange['block']]
+                else:
+                    response = exchange['response']
+                self._exchanges.append((exchange['method'], exchange['args'], response))
+
+    def __getattr__(self, name):
+        if name not in WRITE_METHODS + QUERY_METHODS + READ_METHODS:
+            raise AttributeError(name)
+
+        def replayed_call(*args):
+            if self._position >= len(self._exchanges):
+                raise ValueError("Value Error. %s%s was called after the end of the recording %s." % (name, args, self.path))
+            method, recorded_args, response = self._exchanges[self._position]
+            if method != name or (name in WRITE_METHODS + QUERY_METHODS and args[0] != recorded_args[0]):
+                raise ValueError("Value Error. %s%s differs from exchange %d of %s, %s%s." % (name, args, self._position, self.path, method, recorded_args))
+            self._position += 1
+            return response
+        return replayed_call
+
+    def close(self):
+        """
+        Does nothing, there is no instrument to close.
+        """
+        pass